@@ -0,0 +1,169 @@
+"""
+Benchmarks for english_hash. Generates synthetic files in a temporary directory
+(a sparse file, a file of random bytes, and many small files) and times full-file
+hashing, randomised subsampling across a grid of parameters, word encoding and
+multi-file runs. Results are printed as JSON, one entry per case, giving throughput
+(MB/s, files/s) and p50/p99 latency, so runs can be compared to catch regressions or
+to choose sampling parameters for a particular store.
+
+Files are read once before timing, so results are for a warm page cache unless
+--dir points at storage that is not cached (or caches are dropped between runs).
+
+    python benchmark.py --size 256 --out results.json
+"""
+
+import sys, os, time, json, tempfile, argparse
+import english_hash
+
+
+def make_files(path, size, n_small=2000, small_size=4096):
+    """Create the synthetic files in the directory path: sparse.bin and random.bin of
+    size bytes each, and n_small files of small_size random bytes in small/.
+    Returns a dict of the paths created."""
+    sparse = os.path.join(path, "sparse.bin")
+    with open(sparse, "wb") as f:
+        f.truncate(size)
+
+    rand = os.path.join(path, "random.bin")
+    with open(rand, "wb") as f:
+        for start in range(0, size, 1024*1024):
+            f.write(os.urandom(min(1024*1024, size-start)))
+
+    small_dir = os.path.join(path, "small")
+    os.mkdir(small_dir)
+    small = []
+    for i in range(n_small):
+        fname = os.path.join(small_dir, "%05d.bin" % i)
+        with open(fname, "wb") as f:
+            f.write(os.urandom(small_size))
+        small.append(fname)
+    return dict(sparse=sparse, random=rand, small=small)
+
+
+def percentile(times, q):
+    """Return the q'th percentile (0-100) of times, by nearest rank."""
+    times = sorted(times)
+    return times[min(len(times)-1, int(q/100.0*len(times)))]
+
+
+def measure(fn, repeat):
+    """Call fn repeat times, returning the list of times taken, in seconds."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-start)
+    return times
+
+
+def result(name, times, nbytes=None, nfiles=None, **params):
+    """Summarise the times of a benchmark case as a dict. nbytes and nfiles are the
+    amount of data and number of files each timed call processed."""
+    p50 = percentile(times, 50)
+    out = dict(name=name, params=params, runs=len(times), p50_s=p50, p99_s=percentile(times, 99))
+    if nbytes is not None:
+        out["mb_per_s"] = nbytes/p50/1e6 if p50>0 else None
+    if nfiles is not None:
+        out["files_per_s"] = nfiles/p50 if p50>0 else None
+    return out
+
+
+def hash_path(fname, algo="sha512", **kwargs):
+    """Return the digest of the file at fname, as english_hash.digest."""
+    with open(fname, "rb") as f:
+        return english_hash.digest(english_hash.new_hash(algo), f, **kwargs)
+
+
+def bench_full(files, repeat):
+    """Time sha_file on the sparse and random files, for each algorithm and read path."""
+    for kind in "sparse", "random":
+        fname = files[kind]
+        size = os.path.getsize(fname)
+        for algo in sorted(english_hash.hash_backends):
+            for use_mmap in True, False:
+                times = measure(lambda: hash_path(fname, algo=algo, use_mmap=use_mmap), repeat)
+                yield result("sha_file", times, nbytes=size, file=kind, algo=algo, mmap=use_mmap)
+
+
+def bench_random(files, repeat):
+    """Time sha_file_random on the random file across percent, blocks, block_size
+    and queue_depth. mb_per_s is for the bytes actually sampled."""
+    fname = files["random"]
+    size = os.path.getsize(fname)
+    grid = [dict(percent=p) for p in (0.1, 1.0, 10.0)]+[dict(blocks=b) for b in (100, 1000, 10000)]
+    for sample in grid:
+        for block_size in 512, 4096, 65536:
+            for queue_depth in 1, 8:
+                options = dict(sample, block_size=block_size, queue_depth=queue_depth, min_blocks=None)
+                if "percent" in sample:
+                    n_blocks = int(((size/block_size)*sample["percent"])/100)
+                else:
+                    n_blocks = sample["blocks"]
+                times = measure(lambda: hash_path(fname, **options), repeat)
+                yield result("sha_file_random", times, nbytes=min(size, (n_blocks+2)*block_size), **options)
+
+
+def bench_encode(repeat, n=10000):
+    """Time key_to_english on one digest at a time, and encode_many on a batch of n."""
+    digests = [os.urandom(65) for i in range(n)]
+    words = english_hash.get_wordlist()
+    times = measure(lambda: [english_hash.key_to_english(d, words) for d in digests], repeat)
+    yield dict(result("key_to_english", times, digests=n), digests_per_s=n/percentile(times, 50))
+    times = measure(lambda: english_hash.encode_many(digests), repeat)
+    yield dict(result("encode_many", times, digests=n), digests_per_s=n/percentile(times, 50))
+
+
+def bench_multi(files, repeat):
+    """Time digest_files over the small files, serially and on thread and process pools."""
+    small = files["small"]
+    nbytes = sum(os.path.getsize(fname) for fname in small)
+    # at least two workers, so the pools are exercised even on a single CPU
+    jobs = max(2, os.cpu_count() or 1)
+    for options in dict(jobs=1), dict(jobs=jobs), dict(jobs=jobs, processes=True), dict(jobs=jobs, ordered=False):
+        times = measure(lambda: list(english_hash.digest_files(small, **options)), repeat)
+        yield result("digest_files", times, nbytes=nbytes, nfiles=len(small), **options)
+    # per-file latency, hashing one file at a time
+    times = []
+    for fname in small:
+        times += measure(lambda: english_hash.digest_file(fname), 1)
+    yield result("digest_file", times, nbytes=os.path.getsize(small[0]), nfiles=1)
+
+
+def run(path, size, repeat=5, n_small=2000):
+    """Create the benchmark files under path and run every benchmark, returning
+    the list of results."""
+    files = make_files(path, size, n_small=n_small)
+    # warm the page cache, so the first case is not penalised
+    for fname in [files["sparse"], files["random"]]+files["small"]:
+        hash_path(fname)
+    results = []
+    for bench in bench_full(files, repeat), bench_random(files, repeat), bench_encode(repeat), bench_multi(files, repeat):
+        for r in bench:
+            print("%-16s %s" % (r["name"], json.dumps(r["params"], sort_keys=True)), file=sys.stderr)
+            results.append(r)
+    return results
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark english_hash hashing and encoding on synthetic files, printing the results as JSON.')
+    parser.add_argument('--size', dest='size', metavar='<MB>', type=int, default=64,
+                   help='Size of the large synthetic files, in megabytes. Default is 64.')
+    parser.add_argument('--small-files', dest='n_small', metavar='<n>', type=int, default=2000,
+                   help='Number of small (4kb) files for the multi-file benchmarks. Default is 2000.')
+    parser.add_argument('--repeat', dest='repeat', metavar='<n>', type=int, default=5,
+                   help='Number of times each case is timed. Default is 5.')
+    parser.add_argument('--dir', dest='dir', metavar='<path>', type=str,
+                   help='Directory in which to create the synthetic files. Default is a temporary directory.')
+    parser.add_argument('--out', dest='out', metavar='<path>', type=str,
+                   help='Write the results to this file rather than standard output.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as path:
+        results = run(path, args.size*1024*1024, repeat=args.repeat, n_small=args.n_small)
+    report = dict(python=sys.version.split()[0], cpus=os.cpu_count(), size_mb=args.size, results=results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
@@ -5,7 +5,7 @@ of a file. This allows for very fast hashing of large files with adjustable prob
 of collision. 
 
 A list of 4096 short (mainly one and two syllable) common English word is used to encode
-the hash in 12 bit blocks. The hash is padded out to 528 bits so 43 complete words
+the hash in 12 bit blocks. The hash is padded out to 520 bits so 43 complete words
 can be formed. 
 
 The script can return any subset of the hash words (e.g. first four words). This makes
@@ -24,7 +24,7 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import bz2, base64, sys, hashlib, math, os, argparse, random
+import sys, hashlib, os, time, _thread
 
 # The word list, as a space separated string, bzip2'd and base64 encoded
 compressed_wordlist = """
@@ -223,64 +223,591 @@ m/DYk/2FHV+34SArt2bs5cy+NtDhQ7uSJXJlh7tEsMoCGVG0nJlUGy01L11sCNr5Kl/Z5pLYDxfFuZbO
 nbKRFny6DKTPwm0NI9OXHFijXVl2wMX/jvRS7TziqHU+wrj1TI5IJSe/ctFeb4Srr6X1NKJgdUONqbGn
 +b29DP4u5IpwoSHqsp5y"""
 
-# decompress the string into a list of 4096 words
-wordlist = bz2.decompress(base64.b64decode(compressed_wordlist)).split(" ")
+# the decoded word list is cached in this file, one word per line, after a header
+# identifying the compressed list it came from; it is rebuilt if missing or stale
+wordlist_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), "english_hash.words")
+
+_wordlist = None
+_word_index = None
+
+
+def _decode_wordlist():
+    """Decompress compressed_wordlist into a list of 4096 words, using the
+    cached copy in wordlist_cache if it is present and up to date."""
+    tag = hashlib.sha1(compressed_wordlist.encode("ascii")).hexdigest()
+    try:
+        with open(wordlist_cache, "r") as f:
+            words = f.read().split("\n")
+        if words[0]==tag and len(words)==4097:
+            return words[1:]
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    import bz2, binascii
+    words = bz2.decompress(binascii.a2b_base64(compressed_wordlist)).decode("ascii").split(" ")
+    try:
+        # write to a temporary file first, so concurrent runs never see a partial cache
+        tmp = "%s.%d.tmp" % (wordlist_cache, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("\n".join([tag]+words))
+        os.replace(tmp, wordlist_cache)
+    except OSError:
+        # e.g. a read-only install; just decode again next time
+        pass
+    return words
+
+
+def get_wordlist():
+    """Return the list of 4096 words, decoding it on first use. The list is
+    also available as the module attribute wordlist."""
+    global _wordlist
+    if _wordlist is None:
+        _wordlist = _decode_wordlist()
+    return _wordlist
+
+
+def word_index():
+    """Return a dict mapping each word in the word list, lower-cased, to its index,
+    built on first use. No two words differ only in case."""
+    global _word_index
+    if _word_index is None:
+        _word_index = dict((word.lower(), i) for i, word in enumerate(get_wordlist()))
+    return _word_index
+
+
+def __getattr__(name):
+    # decode the word list only when wordlist is first accessed
+    if name=="wordlist":
+        return get_wordlist()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 def key_to_english(s, words):
     """Take a string of 8-bit characters s and a list of words.
     Encode the string by indexing into the wordlist, treating the string
-    as a stream of bits from which indices can be formed. """
+    as a big-endian stream of bits from which indices can be formed. Any bits
+    left over after the last complete index form one final, shorter index. """
     # compute max number of bits this word list can encode (i.e. max index)
-    nbits = int(math.floor(math.log(len(words))/math.log(2)))
-    out = []
-    ix = 0
-    n = 0       
-    for char in s:
-        byte = ord(char)        
-        while byte!=0:
-            ix = ix << 1
-            ix = ix | (byte&1)            
-            byte = byte >> 1
-            n = n + 1                    
-            if n==nbits:
-                out.append(words[ix])                
-                n = 0
-                ix = 0              
+    nbits = len(words).bit_length()-1
+    mask = (1<<nbits)-1
+    # treat the whole string as one integer, and slice indices off it
+    total = len(s)*8
+    value = int.from_bytes(s, "big")
+    n, trailing = divmod(total, nbits)
+    out = [words[(value>>shift)&mask] for shift in range(total-nbits, trailing-1, -nbits)]
     # output trailing words
-    if n>0:
-        out.append(words[ix])
+    if trailing>0:
+        out.append(words[value&((1<<trailing)-1)])
     return out
 
 
-def sha_file(sha, f):    
-    """Compute the SHA hash of the given file-like object, reading
-    one 1Mb block at a time. Return the full hash, plus a secondary
-    hash (computed by feeding the digest back in) to use as extra padding"""        
-    read = None
-    while read!='':
-        read = f.read(1024*1024)
-        sha.update(read)
-        
+def english_to_key(s, words=None):
+    """The inverse of key_to_english: take a sequence of words s (a list, or a
+    space-separated string) and return (key, nbits), where key is the bit string the
+    words encode, as bytes padded with zero bits to a whole byte, and nbits is the
+    number of bits encoded. Words are matched ignoring case; words defaults to the
+    built-in word list. Raises ValueError for a word not in the list.
+
+    Each word is decoded as a complete index, so a trailing short word from
+    key_to_english is not recovered exactly; word hashes only ever use complete words."""
+    if words is None:
+        words = get_wordlist()
+        index = word_index()
+    else:
+        index = dict((word.lower(), i) for i, word in enumerate(words))
+    if isinstance(s, str):
+        s = s.split()
+    nbits = len(words).bit_length()-1
+    value = 0
+    for word in s:
+        try:
+            value = (value<<nbits) | index[word.lower()]
+        except KeyError:
+            raise ValueError("%r is not in the word list" % word)
+    total = len(s)*nbits
+    padding = -total%8
+    return (value<<padding).to_bytes((total+padding)//8, "big"), total
+
+
+def encode_many(digests, words=None):
+    """Encode each string in digests with key_to_english, returning a list of
+    word lists. words defaults to the built-in word list.
+
+    If NumPy is available and the digests are all the same length, the whole batch is
+    split into 12-bit indices in one vectorised pass; otherwise each digest is
+    encoded in turn. The output is identical either way. """
+    if words is None:
+        words = get_wordlist()
+    digests = list(digests)
+    lengths = set(len(d) for d in digests)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is None or len(lengths)!=1 or 0 in lengths or len(words).bit_length()-1!=12:
+        return [key_to_english(d, words) for d in digests]
+
+    length = lengths.pop()
+    total = length*8
+    n, trailing = divmod(total, 12)
+    # pad each row to a whole number of 3 byte groups, each giving two 12 bit indices
+    rows = numpy.zeros((len(digests), -(-length//3)*3), dtype=numpy.uint16)
+    rows[:, :length] = numpy.frombuffer(b"".join(digests), dtype=numpy.uint8).reshape(-1, length)
+    groups = rows.reshape(len(digests), -1, 3)
+    ix = numpy.empty((len(digests), groups.shape[1]*2), dtype=numpy.uint16)
+    ix[:, 0::2] = (groups[:, :, 0]<<4) | (groups[:, :, 1]>>4)
+    ix[:, 1::2] = ((groups[:, :, 1]&0xf)<<8) | groups[:, :, 2]
+    ix = ix[:, :n+(trailing>0)]
+    if trailing>0:
+        # the trailing index holds only the remaining low bits, as in key_to_english
+        ix[:, n] >>= 12-trailing
+    return numpy.array(words, dtype=object)[ix].tolist()
+
+
+class Stats(object):
+    """Counters for the hashing hot paths: files hashed, bytes and number of reads and
+    seeks, bytes fed to the hash, seconds spent in I/O, in the hash and in word encoding,
+    and cache hits and misses. Pass an instance as stats= to sha_file, sha_file_random,
+    sha_stream_random, digest, hash_to_words or any of the file-level functions built on
+    them; without one, the hot paths run uninstrumented.
+
+    If callback is given, digest_files calls it as callback(fname, file_stats) after
+    each file, where file_stats is a Stats holding the counts for that file alone.
+
+    Time spent in page faults on memory-mapped files is counted as hash time, and the
+    reads are counted as one read of the whole file."""
+    fields = ("files", "bytes_read", "reads", "seeks", "bytes_hashed",
+              "io_time", "digest_time", "encode_time", "cache_hits", "cache_misses")
+
+    def __init__(self, callback=None):
+        import threading
+        for field in self.fields:
+            setattr(self, field, 0)
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # sent back from worker processes without the lock or callback
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.add(**state)
+
+    def add(self, **counts):
+        """Add to the named counters; safe to call from several threads."""
+        with self.lock:
+            for field, value in counts.items():
+                setattr(self, field, getattr(self, field)+value)
+
+    def merge(self, other):
+        """Add all of the counters of the Stats other to this one."""
+        self.add(**other.as_dict())
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def summary(self):
+        """Return a short, human-readable summary of the counters."""
+        return ("files: %d  read: %.1f MB in %d reads, %d seeks  hashed: %.1f MB  cache: %d hits, %d misses\n"
+                "time: io %.3fs  digest %.3fs  encode %.3fs" % (
+                self.files, self.bytes_read/1e6, self.reads, self.seeks, self.bytes_hashed/1e6,
+                self.cache_hits, self.cache_misses, self.io_time, self.digest_time, self.encode_time))
+
+
+class _TimedHash(object):
+    """Wraps a hash object, adding the time spent in update() and digest() to a Stats."""
+
+    def __init__(self, sha, stats):
+        self.sha = sha
+        self.stats = stats
+        self.clock = time.perf_counter
+
+    def update(self, data):
+        start = self.clock()
+        self.sha.update(data)
+        self.stats.add(digest_time=self.clock()-start, bytes_hashed=memoryview(data).nbytes)
+
+    def digest(self):
+        start = self.clock()
+        digest = self.sha.digest()
+        self.stats.add(digest_time=self.clock()-start)
+        return digest
+
+    def __getattr__(self, name):
+        return getattr(self.sha, name)
+
+
+class _CountedFile(object):
+    """Wraps a file-like object, counting reads and seeks and their time in a Stats."""
+
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+        self.clock = time.perf_counter
+
+    def __getattr__(self, name):
+        attr = getattr(self.f, name)
+        if name not in ("read", "readinto", "seek"):
+            return attr
+
+        def counted(*args):
+            start = self.clock()
+            result = attr(*args)
+            elapsed = self.clock()-start
+            if name=="seek":
+                self.stats.add(io_time=elapsed, seeks=1)
+            else:
+                nbytes = result if name=="readinto" else len(result)
+                self.stats.add(io_time=elapsed, reads=1, bytes_read=nbytes or 0)
+            return result
+        return counted
+
+
+def _instrument(sha, f, stats):
+    """Wrap sha and f to record into stats, unless they already are."""
+    if not isinstance(sha, _TimedHash):
+        sha = _TimedHash(sha, stats)
+    if not isinstance(f, _CountedFile):
+        f = _CountedFile(f, stats)
+    return sha, f
+
+
+def _mmap_file(f):
+    """Return a read-only mmap of the whole of the file-like object f, or None if f is
+    not a regular, non-empty file positioned at its start (e.g. a pipe or a socket)."""
+    import mmap, stat
+    try:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_size==0 or f.tell()!=0:
+            return None
+        m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, AttributeError):
+        return None
+    if hasattr(m, "madvise"):
+        m.madvise(mmap.MADV_SEQUENTIAL)
+    return m
+
+
+def sha_file(sha, f, block_size=None, use_mmap=False, stats=None):
+    """Compute the SHA hash of the given file-like object, one block_size block
+    (default 1Mb) at a time. Return the full hash, plus a secondary
+    hash (computed by feeding the digest back in) to use as extra padding.
+
+    The file is read into a single reused buffer with readinto(), so pipes and
+    non-seekable streams work too. If use_mmap is True, regular files are instead
+    memory-mapped and fed to the hash as slices of the map, without copying; only use
+    this for files that cannot change while they are hashed, as truncating a mapped
+    file kills the process with SIGBUS.
+    If stats is a Stats, reads and hashing are recorded in it."""
+    if block_size is None:
+        block_size = 1024*1024
+    if stats is not None:
+        sha, f = _instrument(sha, f, stats)
+
+    m = _mmap_file(f) if use_mmap else None
+    if m is not None:
+        if stats is not None:
+            stats.add(reads=1, bytes_read=len(m))
+        with m, memoryview(m) as view:
+            for start in range(0, len(view), block_size):
+                sha.update(view[start:start+block_size])
+    elif hasattr(f, "readinto"):
+        buf = bytearray(block_size)
+        with memoryview(buf) as view:
+            read = f.readinto(buf)
+            while read:
+                sha.update(view[:read])
+                read = f.readinto(buf)
+    else:
+        read = None
+        while read!=b'':
+            read = f.read(block_size)
+            sha.update(read)
+
     hash = sha.digest()
     sha.update(sha.digest())
     hash2 = sha.digest()
     return hash, hash2
-    
-    
-def sha_file_random(sha, f, percent=None, n_blocks=None, min_blocks=100, max_blocks=None, block_size=512, filesize=None):
+
+
+def plan_blocks(size, n_blocks, block_size=512, as_array=False):
+    """Return the sorted offsets of the blocks to inspect in a file of the given size:
+    the first and last blocks, plus n_blocks blocks at pseudo-random offsets.
+
+    The offsets come from a SHAKE-256 stream seeded with the size and sampling parameters,
+    so the plan is the same on every run, platform and Python version, and does not touch
+    the global random module. If NumPy is available the offsets are drawn and sorted in
+    one vectorised pass; the result is identical either way. With as_array, the offsets
+    are returned as a NumPy int64 array rather than a list, when NumPy is available."""
+    span = max(0, size-block_size)
+    seed = ("english_hash blocks %d %d %d" % (size, n_blocks, block_size)).encode("ascii")
+    stream = hashlib.shake_256(seed).digest(8*n_blocks)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        offsets = numpy.empty(n_blocks+2, dtype=numpy.int64)
+        offsets[1:-1] = numpy.frombuffer(stream, dtype="<u8") % numpy.uint64(span+1)
+        offsets[1:-1].sort()
+        # include first and last block always
+        offsets[0], offsets[-1] = 0, span
+        return offsets if as_array else offsets.tolist()
+    import struct
+    offsets = sorted(x%(span+1) for x in struct.unpack("<%dQ" % n_blocks, stream))
+    # include first and last block always
+    return [0]+offsets+[span]
+
+
+def _coalesce_runs(offsets, block_size, max_read):
+    """Return the runs of coalesce_blocks as (starts, lengths, bounds): run k reads
+    lengths[k] bytes at starts[k], and covers the sorted offsets from index bounds[k] up
+    to bounds[k+1]. Runs break wherever a block does not touch the one before it, and
+    any run longer than max_read is then split greedily. These are NumPy arrays, found
+    in a vectorised pass, if offsets is one; otherwise they are lists."""
+    if isinstance(offsets, (list, tuple)):
+        starts, lengths, bounds = [], [], [0]
+        start = end = 0
+        for i, offset in enumerate(offsets):
+            if i and offset<=end and max(end, offset+block_size)-start<=max_read:
+                end = max(end, offset+block_size)
+            else:
+                if i:
+                    starts.append(start)
+                    lengths.append(end-start)
+                    bounds.append(i)
+                start, end = offset, offset+block_size
+        if offsets:
+            starts.append(start)
+            lengths.append(end-start)
+            bounds.append(len(offsets))
+        return starts, lengths, bounds
+
+    import numpy
+    o = offsets
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(o)>block_size)+1, [len(o)]))
+    long_runs = numpy.flatnonzero(o[bounds[1:]-1]+block_size-o[bounds[:-1]]>max_read)
+    if len(long_runs):
+        # few runs are this long, and each split is found by a binary search
+        splits = []
+        for k in long_runs.tolist():
+            i, end = int(bounds[k]), int(bounds[k+1])
+            while True:
+                i = max(i+1, int(numpy.searchsorted(o[:end], o[i]+max_read-block_size, side="right")))
+                if i>=end:
+                    break
+                splits.append(i)
+        bounds = numpy.union1d(bounds, numpy.array(splits, dtype=bounds.dtype))
+    starts = o[bounds[:-1]]
+    return starts, o[bounds[1:]-1]+block_size-starts, bounds
+
+
+def coalesce_blocks(offsets, block_size=512, max_read=1024*1024):
+    """Group sorted block offsets into larger reads. Yields (start, length, offsets)
+    runs, where offsets are the blocks covered by the read of length bytes at start.
+    Blocks that overlap or touch are read together, unless that would make the read
+    longer than max_read bytes. If NumPy is available the run boundaries are found in
+    one vectorised pass; the runs are the same either way."""
+    if len(offsets)==0:
+        return
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        starts, lengths, bounds = _coalesce_runs(numpy.asarray(offsets, dtype=numpy.int64), block_size, max_read)
+        starts, lengths, bounds = starts.tolist(), lengths.tolist(), bounds.tolist()
+    else:
+        starts, lengths, bounds = _coalesce_runs(list(offsets), block_size, max_read)
+    offsets = list(offsets)
+    yield from zip(starts, lengths, map(offsets.__getitem__, map(slice, bounds[:-1], bounds[1:])))
+
+
+def _pread_run(fd, run):
+    """Read a (start, length) run from the file descriptor fd with os.pread,
+    retrying short reads until length bytes or the end of the file is reached."""
+    start, length = run
+    data = os.pread(fd, length, start)
+    while 0<len(data)<length:
+        more = os.pread(fd, length-len(data), start+len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _timed_pread_run(fd, stats, run):
+    """_pread_run, recording the read in stats."""
+    start = time.perf_counter()
+    data = _pread_run(fd, run)
+    stats.add(io_time=time.perf_counter()-start, reads=1, bytes_read=len(data))
+    return data
+
+
+def _read_runs(f, starts, lengths, queue_depth=None, stats=None):
+    """Read lengths[k] bytes at starts[k] from f for each run k, yielding a memoryview
+    of the bytes read for each, in order.
+
+    With a queue_depth above 1, up to that many runs are fetched concurrently with
+    os.pread from a thread pool, which keeps fast or high-latency storage busy. Otherwise
+    (or if f has no file descriptor) runs are read one at a time into a single reused
+    buffer, so each view is only valid until the next is yielded. If stats is a Stats,
+    the concurrent reads are recorded in it (other reads are counted by the file)."""
+    fd = None
+    if queue_depth is not None and queue_depth>1 and hasattr(os, "pread"):
+        try:
+            fd = f.fileno()
+        except (OSError, ValueError, AttributeError):
+            fd = None
+    if fd is not None:
+        import functools, concurrent.futures
+        read = functools.partial(_pread_run, fd)
+        if stats is not None:
+            read = functools.partial(_timed_pread_run, fd, stats)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=queue_depth) as executor:
+            for run, data in _map_bounded(executor, read, zip(starts, lengths), queue_depth):
+                yield memoryview(data)
+        return
+
+    buf = bytearray(max(lengths, default=0))
+    readinto = getattr(f, "readinto", None)
+    with memoryview(buf) as view:
+        for start, length in zip(starts, lengths):
+            f.seek(start)
+            read = readinto(view[:length]) if readinto is not None else None
+            if read is None:
+                data = f.read(length)
+                read = len(data)
+                view[:read] = data
+            yield view[:read]
+
+
+def plan_strata(size, n_blocks, block_size=512, as_array=False):
+    """Return the sorted offsets of the blocks to inspect in a file of the given size,
+    when it is divided into n_blocks equal strata with one block at a pseudo-random
+    offset within each, plus the first and last blocks. Unlike plan_blocks, this leaves
+    no large stretch of the file uninspected. Offsets are drawn from a SHAKE-256 stream
+    as in plan_blocks, and are identical with or without NumPy. as_array is as for
+    plan_blocks."""
+    n_blocks = max(1, n_blocks)
+    seed = ("english_hash strata %d %d %d" % (size, n_blocks, block_size)).encode("ascii")
+    stream = hashlib.shake_256(seed).digest(8*n_blocks)
+    # stratum k covers [lo_k, lo_k+1); lo_k = k*size//n_blocks, split up to avoid overflow
+    width, extra = divmod(size, n_blocks)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        k = numpy.arange(n_blocks+1, dtype=numpy.uint64)
+        lo = k*numpy.uint64(width)+(k*numpy.uint64(extra))//numpy.uint64(n_blocks)
+        span = numpy.maximum(lo[1:]-lo[:-1], numpy.uint64(block_size))-numpy.uint64(block_size-1)
+        offsets = numpy.empty(n_blocks+2, dtype=numpy.int64)
+        offsets[1:-1] = numpy.minimum(lo[:-1]+numpy.frombuffer(stream, dtype="<u8")%span,
+                                      numpy.uint64(max(0, size-block_size)))
+        offsets[0], offsets[-1] = 0, max(0, size-block_size)
+        return offsets if as_array else offsets.tolist()
+    import struct
+    lo = [k*width+(k*extra)//n_blocks for k in range(n_blocks+1)]
+    offsets = [min(lo[k]+x%(max(lo[k+1]-lo[k], block_size)-block_size+1), max(0, size-block_size))
+               for k, x in enumerate(struct.unpack("<%dQ" % n_blocks, stream))]
+    return [0]+offsets+[max(0, size-block_size)]
+
+
+def plan_adaptive(size, detect=4096, confidence=0.999, max_bytes=None, max_seconds=None,
+                  latency=1e-4, bandwidth=500e6, block_sizes=(512, 4096, 65536, 1048576)):
+    """Choose how to sample a file of the given size so that a modification of any detect
+    contiguous bytes changes the hash with probability at least confidence, within an
+    optional budget of max_bytes read or max_seconds taken per file. Time is estimated as
+    latency seconds per read plus bytes read/bandwidth.
+
+    Returns a dict with block_size, n_blocks (for plan_strata), the guarantee achieved
+    (the detection probability), and the estimated bytes, reads and seconds. If reading
+    the whole file is cheaper, or the file is too small to sample, block_size and
+    n_blocks are None and the guarantee is 1. If the budget does not allow the target,
+    the plan within budget with the highest guarantee is returned instead, using
+    blocks smaller than any of block_sizes if need be. Raises ValueError if confidence
+    is not in (0, 1], or if even three one-byte blocks do not fit the budget.
+
+    With one block of size b placed uniformly in each stratum of width w, a modified
+    region overlaps the valid block offsets of one or two strata over at least detect
+    positions, so it is detected with probability at least 1-(1-q/2)**2, where
+    q = min(2, detect/(w-b+1))."""
+    import math
+    if not 0<confidence<=1:
+        raise ValueError("confidence must be in (0, 1], not %r" % (confidence,))
+    if detect<1:
+        raise ValueError("detect must be at least one byte, not %r" % (detect,))
+
+    def seconds(nbytes, reads):
+        return reads*latency+nbytes/bandwidth
+
+    def within(nbytes, secs):
+        return (max_bytes is None or nbytes<=max_bytes) and (max_seconds is None or secs<=max_seconds)
+
+    def guarantee(n, b):
+        q = min(2.0, detect/max(1, -(-size//n)-b+1))
+        return 1-(1-q/2)**2
+
+    plans = []
+    reads = max(1, -(-size//(1024*1024)))
+    full = dict(block_size=None, n_blocks=None, guarantee=1.0, bytes=size, reads=reads, seconds=seconds(size, reads))
+    if within(full["bytes"], full["seconds"]):
+        plans.append(full)
+
+    # the smallest q, and so the widest strata, that meets the target
+    q = 2*(1-math.sqrt(1-confidence)) if confidence<1 else 2.0
+    for b in block_sizes:
+        if 2*b>=size:
+            continue
+        n = -(-size//(int(detect/q)+b-1))
+        # the first and last blocks are always read too
+        if max_bytes is not None:
+            n = min(n, max_bytes//b-2)
+        if max_seconds is not None:
+            n = min(n, int(max_seconds/(latency+b/bandwidth))-2)
+        if n<1 or (n+2)*b>=size:
+            continue
+        plans.append(dict(block_size=b, n_blocks=n, guarantee=guarantee(n, b),
+                          bytes=(n+2)*b, reads=n+2, seconds=seconds((n+2)*b, n+2)))
+
+    if not plans:
+        # nothing fits the budget; take the first, last and one other block, as large as will fit
+        b = block_sizes[0]
+        if max_bytes is not None:
+            b = min(b, max_bytes//3)
+        if max_seconds is not None:
+            b = min(b, int((max_seconds/3-latency)*bandwidth))
+        if b<1:
+            raise ValueError("no sample fits within a budget of %s bytes and %s seconds" % (max_bytes, max_seconds))
+        return dict(block_size=b, n_blocks=1, guarantee=guarantee(1, b), bytes=3*b, reads=3, seconds=seconds(3*b, 3))
+    meeting = [plan for plan in plans if plan["guarantee"]>=confidence]
+    if meeting:
+        return min(meeting, key=lambda plan: plan["seconds"])
+    return max(plans, key=lambda plan: (plan["guarantee"], -plan["seconds"]))
+
+
+def sha_file_random(sha, f, percent=None, n_blocks=None, min_blocks=100, max_blocks=None, block_size=512, filesize=None, queue_depth=None, stratified=False, stats=None):
     """Compute a hash from a randomized set of blocks from a file. Percent specifies the percentage
     of the file to inspect (0.0-100.0); alternatively, n_blocks specifies the number of blocks
     to inspect. min_blocks and max_blocks limit the number of blocks inspected. The size
     of blocks is given by block (default 512).
     
-    Note that this depends on the reproducibility of the Python PRNG. If this changes, hashes
-    will not match.
-    
+    The blocks are chosen by plan_blocks (or plan_strata, if stratified is True), so the
+    same file and parameters always give the same hash. Overlapping and adjacent blocks are fetched in a single read, but
+    the hash is fed each block in offset order, as if they had been read one by one. If queue_depth
+    is above 1, up to that many reads are issued concurrently (see _read_runs); the
+    hash is the same for any queue depth. If stats is a Stats, reads, seeks and
+    hashing are recorded in it.
+
     The file object must support seek(), and if filesize is not specified, must be a real file.    
     """
     if block_size is None:
         block_size = 512
+    if stats is not None:
+        sha, f = _instrument(sha, f, stats)
         
     # check file size
     if filesize is None:
@@ -296,85 +823,1145 @@ def sha_file_random(sha, f, percent=None, n_blocks=None, min_blocks=100, max_blo
     if max_blocks is not None:
         n_blocks = min(n_blocks, max_blocks)     
         
-    # include first and last block always
-    block_offsets = [0] + [random.randint(0,max(0,size-block_size)) for i in range(n_blocks)] + [size-block_size]
-    
-    # sort to minimise seek time
-    block_offsets = sorted(block_offsets)        
+    # sorted, to minimise seek time
+    if stratified:
+        block_offsets = plan_strata(size, n_blocks, block_size, as_array=True)
+    else:
+        block_offsets = plan_blocks(size, n_blocks, block_size, as_array=True)
         
-    # use consistent seed
-    sha.update(str(size))
-    random.seed(sha.digest())
+    sha.update(str(size).encode("ascii"))
     
-    for offset in block_offsets:           
-        f.seek(offset)
-        sha.update(f.read(block_size))
+    starts, lengths, bounds = _coalesce_runs(block_offsets, block_size, 1024*1024)
+    # a run whose blocks just touch is the blocks laid end to end, so is hashed in one go;
+    # only runs with overlapping or repeated blocks need feeding block by block
+    if isinstance(lengths, list):
+        disjoint = [length==(j-i)*block_size for length, i, j in zip(lengths, bounds, bounds[1:])]
+    else:
+        disjoint = (lengths==(bounds[1:]-bounds[:-1])*block_size).tolist()
+        starts, lengths = starts.tolist(), lengths.tolist()
+    for k, view in enumerate(_read_runs(f, starts, lengths, queue_depth, stats)):
+        if disjoint[k]:
+            sha.update(view)
+            continue
+        start = starts[k]
+        offsets = block_offsets[bounds[k]:bounds[k+1]]
+        for offset in (offsets if isinstance(offsets, list) else offsets.tolist()):
+            offset -= start
+            sha.update(view[offset:offset+block_size])
         
     hash = sha.digest()
     sha.update(sha.digest())
     hash2 = sha.digest()    
     return hash, hash2
-    
-def wordhash(sha, f, n=None, blocks=None, percent=None, **kwargs):    
-    """Compute the hash of a file-like object, returning as a space-separated list of words.
-    The encoded string includes one extra byte from a secondary hash, to avoid
-    trailing low-order bits for 12-bit indices. """
-    
-    
-    # use randomisation only if blocks or percent is specified
-    if blocks is not None or percent is not None:
-        hash, hash2 = sha_file_random(sha, f, percent=percent, n_blocks=blocks, **kwargs) 
+
+
+def sha_file_adaptive(sha, f, detect=4096, confidence=0.999, max_bytes=None, max_seconds=None,
+                      queue_depth=None, read_size=None, use_mmap=False, stats=None, plan=None):
+    """Compute the hash of a file, sampled as chosen by plan_adaptive so that a
+    modification of detect contiguous bytes is caught with the given confidence,
+    within the optional budget. When the plan is to read the whole file, or f cannot
+    seek, this is the same as sha_file. If plan is a dict, it is updated with the plan
+    followed, as returned by plan_adaptive; its guarantee is the probability achieved."""
+    if not (hasattr(f, "seekable") and f.seekable()):
+        if plan is not None:
+            plan.update(block_size=None, n_blocks=None, guarantee=1.0)
+        return sha_file(sha, f, block_size=read_size, use_mmap=use_mmap, stats=stats)
+    size = os.fstat(f.fileno()).st_size
+    followed = plan_adaptive(size, detect, confidence, max_bytes=max_bytes, max_seconds=max_seconds)
+    if plan is not None:
+        plan.update(followed)
+    plan = followed
+    if plan["block_size"] is None:
+        return sha_file(sha, f, block_size=read_size, use_mmap=use_mmap, stats=stats)
+    return sha_file_random(sha, f, n_blocks=plan["n_blocks"], min_blocks=None, block_size=plan["block_size"],
+                           filesize=size, queue_depth=queue_depth, stratified=True, stats=stats)
+
+
+def _uniforms(seed):
+    """Yield an endless, repeatable stream of floats in (0, 1), from BLAKE2b keyed
+    with seed and run in counter mode."""
+    counter = 0
+    while True:
+        block = hashlib.blake2b(counter.to_bytes(8, "little"), key=seed).digest()
+        for i in range(0, len(block), 8):
+            yield ((int.from_bytes(block[i:i+8], "little")>>11)+0.5)/(1<<53)
+        counter += 1
+
+
+def _readfull(f, view):
+    """Fill view from f, retrying the short reads pipes give, and return the number
+    of bytes read, which is less than len(view) only at the end of the stream."""
+    filled = 0
+    while filled<len(view):
+        if hasattr(f, "readinto"):
+            read = f.readinto(view[filled:])
+        else:
+            data = f.read(len(view)-filled)
+            read = len(data)
+            view[filled:filled+read] = data
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def sha_stream_random(sha, f, percent=None, n_blocks=None, block_size=512, read_size=None, stats=None):
+    """Compute a hash from a randomized set of blocks from a stream that cannot seek and
+    whose size is not known in advance, such as a pipe. The whole stream is read, through
+    a single reused buffer of read_size bytes (default 1Mb), but only the sampled blocks are
+    hashed.
+
+    With percent, each block is sampled independently with that probability and hashed
+    as soon as it is read. With n_blocks, a reservoir of n_blocks blocks is sampled
+    uniformly from the whole stream, holding n_blocks*block_size bytes in memory, and
+    hashed at the end. As in sha_file_random, the first and last block are always hashed,
+    followed by the size. min_blocks and max_blocks do not apply.
+
+    The sample is repeatable, being drawn from a stream seeded with the parameters, but
+    differs from the sample sha_file_random takes from a file of the same size.
+    If stats is a Stats, reads and hashing are recorded in it."""
+    import math
+    if block_size is None:
+        block_size = 512
+    if stats is not None:
+        sha, f = _instrument(sha, f, stats)
+    if read_size is None:
+        read_size = 1024*1024
+    # read whole blocks at a time, so no block straddles two reads
+    chunk_size = max(1, read_size//block_size)*block_size
+    seed = hashlib.blake2b(("english_hash stream %r %r %d" % (percent, n_blocks, block_size)).encode("ascii")).digest()
+    uniform = _uniforms(seed)
+    reservoir = {}
+
+    if percent is not None:
+        p = min(1.0, percent/100)
+
+        def skip():
+            # number of blocks to pass over before the next one sampled, geometrically distributed
+            if p<=0:
+                return math.inf
+            return 0 if p==1 else int(math.log(next(uniform))/math.log1p(-p))
+
+        def pick(i, block):
+            sha.update(block)
+            return i+1+skip()
+        next_pick = 1+skip()
     else:
-        hash, hash2 = sha_file(sha, f)     
+        # Li's Algorithm L, which only draws random numbers for the blocks it keeps
+        k = n_blocks
+        w = math.exp(math.log(next(uniform))/k) if k>0 else 0.0
+
+        def pick(i, block):
+            nonlocal w
+            if len(reservoir)<k:
+                reservoir[len(reservoir)] = (i, bytes(block))
+                if len(reservoir)<k:
+                    return i+1
+            else:
+                reservoir[int(next(uniform)*k)] = (i, bytes(block))
+                w *= math.exp(math.log(next(uniform))/k)
+            return i+1+int(math.log(next(uniform))/math.log1p(-w))
+        next_pick = 1 if k>0 else math.inf
+
+    # blocks are numbered from the start of the stream; block 0 is always hashed first
+    size = 0
+    tail = b""
+    buf = bytearray(chunk_size)
+    with memoryview(buf) as view:
+        read = chunk_size
+        while read==chunk_size:
+            read = _readfull(f, view)
+            data = view[:read]
+            if size==0:
+                sha.update(data[:block_size])
+            first = size//block_size
+            end = first+(read+block_size-1)//block_size
+            while next_pick<end:
+                start = (next_pick-first)*block_size
+                next_pick = pick(next_pick, data[start:start+block_size])
+            tail = (tail+bytes(data[-block_size:]))[-block_size:]
+            size += read
+
+    for i, block in sorted(reservoir.values()):
+        sha.update(block)
+    sha.update(tail)
+    sha.update(str(size).encode("ascii"))
+
+    hash = sha.digest()
+    sha.update(sha.digest())
+    hash2 = sha.digest()
+    return hash, hash2
+
+
+def digest(sha, f, blocks=None, percent=None, detect=None, read_size=None, use_mmap=False, stats=None, plan=None, **kwargs):
+    """Compute the (hash, hash2) pair of a file-like object, using the randomised
+    subsample only if blocks or percent is specified. read_size and use_mmap
+    are passed to sha_file for full-file hashing. Streams that cannot seek, such as
+    pipes, are subsampled with sha_stream_random. If detect is given, the file is
+    sampled adaptively by sha_file_adaptive, which takes the confidence, max_bytes,
+    max_seconds and queue_depth options, and records the plan it follows in the dict
+    plan, if given. stats is passed to each. """
+    if detect is not None:
+        # the block size and count are chosen by the planner, so the other sampling options do not apply
+        adaptive = dict((key, kwargs[key]) for key in ("confidence", "max_bytes", "max_seconds", "queue_depth") if key in kwargs)
+        return sha_file_adaptive(sha, f, detect, read_size=read_size, use_mmap=use_mmap, stats=stats, plan=plan, **adaptive)
+    if blocks is not None or percent is not None:
+        if not (hasattr(f, "seekable") and f.seekable()):
+            return sha_stream_random(sha, f, percent=percent, n_blocks=blocks, block_size=kwargs.get("block_size"),
+                                     read_size=read_size, stats=stats)
+        return sha_file_random(sha, f, percent=percent, n_blocks=blocks, stats=stats, **kwargs)
+    return sha_file(sha, f, block_size=read_size, use_mmap=use_mmap, stats=stats)
+
+
+def hash_to_words(hash, hash2, n=None, stats=None):
+    """Encode a (hash, hash2) pair as a space-separated list of words.
+    The encoded string includes one extra byte from the secondary hash, to avoid
+    trailing low-order bits for 12-bit indices. If stats is a Stats, the time taken
+    is added to its encode_time. """
+    if stats is not None:
+        start = time.perf_counter()
+        words = hash_to_words(hash, hash2, n=n)
+        stats.add(encode_time=time.perf_counter()-start)
+        return words
     word_bits = 12
     char_bits = 8
-    padding = word_bits-((len(hash)*char_bits)%word_bits)
-    padding_bytes = padding//char_bits
-    words = key_to_english(hash+hash2[0:padding_bytes], wordlist)
+    padding = -(len(hash)*char_bits)%word_bits
+    padding_bytes = -(-padding//char_bits)
+    # keep only the complete words; the padding byte may leave a few spare bits
+    n_complete = (len(hash)*char_bits+padding)//word_bits
+    words = key_to_english(hash+hash2[0:padding_bytes], get_wordlist())[0:n_complete]
     if n!=None:
-        words = words[0:n]        
+        words = words[0:n]
     return " ".join(words)
 
 
+def wordhash(sha, f, n=None, blocks=None, percent=None, stats=None, **kwargs):
+    """Compute the hash of a file-like object, returning as a space-separated list of words.
+    See hash_to_words for the encoding. """
+    hash, hash2 = digest(sha, f, blocks=blocks, percent=percent, stats=stats, **kwargs)
+    return hash_to_words(hash, hash2, n=n, stats=stats)
+
+
 def wordhash_file(sha, fname, **kwargs):
-    """Hash the file with the given path, returning the space-separated word form. 
+    """Hash the file with the given path, returning the space-separated word form.
     Just a wrapper for wordhash that opens the given file. """
     with open(fname, "rb") as f:
         return wordhash(sha, f, **kwargs)
-        
-if __name__=="__main__":
+
+
+# the thread pool shared by Blake2bTree objects; see _tree_pool
+_tree_executor = None
+# from _thread, as threading is slow to import and not otherwise needed at start-up
+_tree_lock = _thread.allocate_lock()
+
+
+def _tree_pool():
+    """Return the thread pool shared by Blake2bTree objects, creating it on first use."""
+    global _tree_executor
+    with _tree_lock:
+        if _tree_executor is None:
+            import concurrent.futures
+            _tree_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _tree_executor
+
+
+def _reset_tree_pool():
+    # a forked child (e.g. a process pool worker) has none of its parent's threads,
+    # so leaves submitted to the inherited pool would never run
+    global _tree_executor, _tree_lock
+    _tree_executor = None
+    _tree_lock = _thread.allocate_lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_tree_pool)
+
+
+class Blake2bTree(object):
+    """A hash object computing a BLAKE2b tree hash, in which the input is split into
+    leaf_size leaves that are hashed in parallel on a shared thread pool, and the leaf
+    digests are then hashed into a single root (BLAKE2 tree mode, with unlimited fanout
+    and depth 2). This lets a single large file use every core.
+
+    Supports update() and digest() like a hashlib object. digest() does not finalise
+    the state, so more data can be added afterwards."""
+    name = "blake2b-tree"
+    digest_size = 64
+
+    def __init__(self, data=b"", leaf_size=1024*1024):
+        self.leaf_size = leaf_size
+        self.max_pending = 2*(os.cpu_count() or 1)
+        # the digests of completed leaves, or futures for those still being hashed
+        self.leaves = []
+        self.buf = bytearray()
+        self.update(data)
+
+    def _node(self, node_offset=0, node_depth=0, last_node=False):
+        return hashlib.blake2b(fanout=0, depth=2, leaf_size=self.leaf_size, inner_size=self.digest_size,
+                               node_offset=node_offset, node_depth=node_depth, last_node=last_node)
+
+    def _leaf(self, data, node_offset, last_node):
+        leaf = self._node(node_offset, last_node=last_node)
+        leaf.update(data)
+        return leaf.digest()
+
+    def update(self, data):
+        with memoryview(data) as view:
+            view = view.cast("B")
+            pos = 0
+            while pos<len(view):
+                # a full buffer is only known not to be the last leaf once more data arrives
+                if len(self.buf)==self.leaf_size:
+                    self.leaves.append(_tree_pool().submit(self._leaf, self.buf, len(self.leaves), False))
+                    self.buf = bytearray()
+                    # bound the number of leaves waiting to be hashed
+                    waiting = len(self.leaves)-1-self.max_pending
+                    if waiting>=0 and not isinstance(self.leaves[waiting], bytes):
+                        self.leaves[waiting] = self.leaves[waiting].result()
+                take = min(self.leaf_size-len(self.buf), len(view)-pos)
+                self.buf += view[pos:pos+take]
+                pos += take
+
+    def digest(self):
+        root = self._node(node_depth=1, last_node=True)
+        for i, leaf in enumerate(self.leaves):
+            if not isinstance(leaf, bytes):
+                leaf = self.leaves[i] = leaf.result()
+            root.update(leaf)
+        root.update(self._leaf(self.buf, len(self.leaves), True))
+        return root.digest()
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+# the available hash algorithms, by name; each is called with no arguments to
+# give a fresh object with update() and digest() methods
+hash_backends = {
+    "sha512": hashlib.sha512,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "blake2b-tree": Blake2bTree,
+}
+
+
+def new_hash(algo="sha512"):
+    """Return a fresh hash object for the named algorithm in hash_backends."""
+    try:
+        return hash_backends[algo]()
+    except KeyError:
+        raise ValueError("Unknown hash algorithm %r; expected one of %s" % (algo, ", ".join(sorted(hash_backends))))
+
+
+def digest_file(fname, algo="sha512", **kwargs):
+    """Hash the file with the given path using a fresh hash object of the named
+    algorithm (see hash_backends), returning the (hash, hash2) pair. The path "-"
+    reads standard input. Each call is independent of any other, so this is safe to
+    run from worker threads or processes. """
+    if fname=="-":
+        return digest(new_hash(algo), sys.stdin.buffer, **kwargs)
+    with open(fname, "rb") as f:
+        return digest(new_hash(algo), f, **kwargs)
+
+
+def _digest_file_info(fname, algo="sha512", stats=False, plan=False, **kwargs):
+    """As digest_file, but returns (result, stats, plan), where stats is a Stats of
+    the work done for this file alone, if stats is True, and plan is the sampling plan
+    followed (see sha_file_adaptive), if plan is True."""
+    stats = Stats() if stats else None
+    plan = {} if plan else None
+    result = digest_file(fname, algo=algo, stats=stats, plan=plan, **kwargs)
+    if stats is not None:
+        stats.add(files=1)
+    return result, stats, plan
+
+
+# options which change how a file is read, but never its digest
+_io_options = ("read_size", "use_mmap", "queue_depth", "stats")
+
+
+def digest_params(algo="sha512", **kwargs):
+    """Return a canonical string describing the algorithm and digest options
+    (as passed to digest) that determine a file's hash. Options that only affect how the
+    file is read are left out, so changing them does not invalidate cached digests."""
+    import json
+    params = dict((k, v) for k, v in kwargs.items() if k not in _io_options)
+    params["algo"] = algo
+    return json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+
+class HashCache(object):
+    """A persistent cache of file digests, stored in an SQLite database at path.
+
+    Entries are keyed on the absolute path, inode, size and modification time of
+    the file, together with the digest_params string, so a file is only re-read if it
+    has changed or is hashed with different options. At most max_entries digests are
+    kept; the least recently used are evicted when the cache is flushed or closed.
+    The cache may be shared by threads, but should only be used from one process."""
+
+    def __init__(self, path, max_entries=1000000):
+        import sqlite3, threading
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS digests (
+            path TEXT, inode INTEGER, size INTEGER, mtime INTEGER, params TEXT,
+            hash BLOB, hash2 BLOB, used INTEGER,
+            PRIMARY KEY (path, inode, size, mtime, params))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS digests_used ON digests (used)")
+        # a use counter, increasing across runs, for least recently used eviction
+        self.used = self.db.execute("SELECT COALESCE(MAX(used), 0) FROM digests").fetchone()[0]
+        self.writes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, fname, params):
+        """Stat the file with the given path, returning (key, (hash, hash2)) if
+        it is in the cache, or (key, None) if not. key can be passed to store."""
+        st = os.stat(fname)
+        key = (os.path.abspath(fname), st.st_ino, st.st_size, st.st_mtime_ns, params)
+        with self.lock:
+            row = self.db.execute("""SELECT hash, hash2 FROM digests WHERE
+                path=? AND inode=? AND size=? AND mtime=? AND params=?""", key).fetchone()
+            if row is None:
+                return key, None
+            self.used += 1
+            self.db.execute("""UPDATE digests SET used=? WHERE
+                path=? AND inode=? AND size=? AND mtime=? AND params=?""", (self.used,)+key)
+            self._written()
+        return key, (bytes(row[0]), bytes(row[1]))
+
+    def store(self, key, hash, hash2):
+        """Store the digest of the file described by key, as returned by lookup.
+        Files modified within the last two seconds are not stored, as a further write in
+        the same mtime tick would go unnoticed."""
+        if key[3]>time.time_ns()-2*10**9:
+            return
+        with self.lock:
+            self.used += 1
+            self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            key+(hash, hash2, self.used))
+            self._written()
+
+    def _written(self):
+        # commit in batches, so an interrupted run keeps most of its work
+        self.writes += 1
+        if self.writes%1000==0:
+            self.db.commit()
+
+    def flush(self):
+        """Evict the least recently used entries beyond max_entries, and commit."""
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+            if count>self.max_entries:
+                self.db.execute("""DELETE FROM digests WHERE rowid IN
+                    (SELECT rowid FROM digests ORDER BY used LIMIT ?)""", (count-self.max_entries,))
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def _map_bounded(executor, fn, items, window, ordered=True, lookup=None):
+    """Apply fn to each item on the executor, keeping at most window calls in flight.
+    Yields (item, result) pairs, in input order if ordered is True, or in completion
+    order otherwise. If lookup is given, it is called on each item first, and any
+    result other than None is used directly instead of calling fn. """
+    import collections, concurrent.futures
+    items = iter(items)
+    pending = collections.deque() if ordered else set()
+
+    def submit():
+        for item in items:
+            result = lookup(item) if lookup is not None else None
+            if result is not None:
+                future = concurrent.futures.Future()
+                future.set_result(result)
+            else:
+                future = executor.submit(fn, item)
+            future.item = item
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            return True
+        return False
+
+    while len(pending)<window and submit():
+        pass
+    while pending:
+        if ordered:
+            done = [pending.popleft()]
+        else:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            pending.difference_update(done)
+        for future in done:
+            yield future.item, future.result()
+            submit()
+
+
+def _map_jobs(fn, items, jobs, processes=False, ordered=True, lookup=None):
+    """Apply fn to each item, serially in this thread if jobs<=1, or else on a pool of
+    jobs threads (or processes, if processes is True). Yields (item, result) pairs as
+    _map_bounded. If the caller stops early, calls still queued are cancelled."""
+    if jobs<=1:
+        for item in items:
+            result = lookup(item) if lookup is not None else None
+            yield item, result if result is not None else fn(item)
+        return
+
+    # only imported when needed, as it is slow to import
+    import concurrent.futures
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        # keep a few items queued per worker, without materialising the whole list
+        for result in _map_bounded(executor, fn, items, jobs*4, ordered=ordered, lookup=lookup):
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def digest_files(fnames, algo="sha512", jobs=None, processes=False, ordered=True, cache=None, stats=None, plans=None,
+                 **kwargs):
+    """Hash each of the given paths with a fresh hash state per file, yielding
+    (fname, (hash, hash2)) pairs. jobs gives the number of workers (default: one per CPU);
+    with jobs=1 files are hashed serially in this thread. Threads are used unless processes
+    is True; hashlib releases the GIL on large updates, so threads usually scale well on
+    full-file hashing, while processes suit many small files or sampled mode.
+    If ordered is False, results are yielded in completion order instead of input order.
+    If cache is a HashCache, unchanged files are looked up there rather than read, and
+    new digests are stored in it. If stats is a Stats, the work done for every file
+    is added to it, and its callback (if any) is called after each file. If plans is
+    a dict, the adaptive sampling plan followed for each file (see sha_file_adaptive;
+    empty unless detect is given) is stored in it under the file's name. kwargs are
+    passed to digest. """
+    import functools
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if stats is None and plans is None:
+        fn = functools.partial(digest_file, algo=algo, **kwargs)
+    else:
+        # workers count into a Stats per file and record their plan, which are merged in this thread
+        fn = functools.partial(_digest_file_info, algo=algo, stats=stats is not None, plan=plans is not None, **kwargs)
+
+    # cache lookups and stores happen in this thread; only misses go to the workers
+    misses = {}
+    if cache is not None:
+        params = digest_params(algo, **kwargs)
+
+    def lookup(fname):
+        # standard input can only be read from this process, and is never cached
+        if fname=="-":
+            return fn(fname)
+        if cache is None:
+            return None
+        key, result = cache.lookup(fname, params)
+        if result is None:
+            misses[fname] = key
+        elif stats is not None or plans is not None:
+            hit = plan = None
+            if stats is not None:
+                hit = Stats()
+                hit.add(files=1, cache_hits=1)
+            if plans is not None:
+                # the plan depends only on the size and options, so is the one the cached digest followed
+                plan = {}
+                if kwargs.get("detect") is not None:
+                    plan = plan_adaptive(key[2], kwargs["detect"], kwargs.get("confidence", 0.999),
+                                         max_bytes=kwargs.get("max_bytes"), max_seconds=kwargs.get("max_seconds"))
+            result = result, hit, plan
+        return result
+
+    for fname, result in _map_jobs(fn, fnames, jobs, processes=processes, ordered=ordered, lookup=lookup):
+        if stats is not None or plans is not None:
+            result, file_stats, plan = result
+            if plans is not None:
+                plans[fname] = plan
+        if stats is not None:
+            if fname in misses:
+                file_stats.add(cache_misses=1)
+            stats.merge(file_stats)
+            if stats.callback is not None:
+                stats.callback(fname, file_stats)
+        if fname in misses:
+            cache.store(misses.pop(fname), *result)
+        yield fname, result
+
+
+def _tree_node(sha, children):
+    """Compute the (hash, hash2) pair of a directory node, from a list of
+    (name, is_dir, hash) entries for its children. Each child's name and type are
+    hashed along with its digest, so renaming or moving a file changes the tree hash."""
+    sha.update(b"english_hash tree\0")
+    for name, is_dir, hash in sorted(children):
+        sha.update(b"d" if is_dir else b"f")
+        sha.update(os.fsencode(name)+b"\0")
+        sha.update(hash)
+    hash = sha.digest()
+    sha.update(sha.digest())
+    hash2 = sha.digest()
+    return hash, hash2
+
+
+def digest_tree(top, algo="sha512", **kwargs):
+    """Hash every regular file under the directory top and combine the digests into a
+    Merkle tree, in which each directory is hashed from the names and digests of its
+    entries. Returns a dict mapping each directory path, relative to top ("." for top
+    itself), to its (hash, hash2) pair.
+
+    The tree is walked with os.scandir while the files are hashed concurrently by
+    digest_files, which takes the remaining kwargs (jobs, processes, cache and the digest
+    options). Symbolic links to directories are not followed. Directory nodes are cheap
+    to recompute, so with a cache only changed files are read again. """
+    # children of each directory, as (name, is_dir, path) entries, in the order found
+    listing = {}
+
+    def walk():
+        stack = ["."]
+        while stack:
+            rel = stack.pop()
+            children = listing[rel] = []
+            with os.scandir(os.path.join(top, rel)) as it:
+                for entry in it:
+                    path = os.path.normpath(os.path.join(rel, entry.name))
+                    if entry.is_dir(follow_symlinks=False):
+                        children.append((entry.name, True, path))
+                        stack.append(path)
+                    elif entry.is_file():
+                        children.append((entry.name, False, path))
+                        yield os.path.join(top, path)
+
+    hashes = {}
+    for fname, (hash, hash2) in digest_files(walk(), algo=algo, ordered=False, **kwargs):
+        hashes[os.path.normpath(os.path.relpath(fname, top))] = hash
+
+    # directories are listed before their subdirectories, so build the tree in reverse
+    nodes = {}
+    for rel in reversed(list(listing)):
+        children = [(name, is_dir, nodes[path][0] if is_dir else hashes[path])
+                    for name, is_dir, path in listing[rel]]
+        nodes[rel] = _tree_node(new_hash(algo), children)
+    return nodes
+
+
+def wordhash_files(fnames, n=None, stats=None, **kwargs):
+    """Hash each of the given paths, yielding (fname, words) pairs.
+    Takes the same options as digest_files. """
+    for fname, (hash, hash2) in digest_files(fnames, stats=stats, **kwargs):
+        yield fname, hash_to_words(hash, hash2, n=n, stats=stats)
+
+
+class HashIndex(object):
+    """A persistent index from digest prefixes to file records, so that the file matching
+    a few words of its hash can be found without rehashing or scanning a manifest.
+
+    The index is stored in the file at path as a sorted array of the first 64 bits of each
+    digest, an array of record offsets, and the records themselves as JSON lines. Loading
+    maps the file and only decodes the records that match a lookup, so a lookup among
+    millions of hashes takes a binary search and a few microseconds.
+
+    Records added with add() are kept in memory and merged into the file by save(). A
+    record replaces any earlier one with the same path and digest parameters."""
+    magic = b"EHIDX1\n"
+
+    def __init__(self, path):
+        import array
+        self.path = path
+        self.prefixes = array.array("Q")
+        self.offsets = array.array("Q", [0])
+        self.records = b""
+        self.added = []
+        if os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self.prefixes)+len(self.added)
+
+    def _load(self):
+        import array, mmap
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(self.magic)]!=self.magic:
+            raise ValueError("%s is not a hash index" % self.path)
+        pos = len(self.magic)
+        count = int.from_bytes(data[pos:pos+8], "little")
+        pos += 8
+        self.prefixes = array.array("Q")
+        self.offsets = array.array("Q")
+        for table in self.prefixes, self.offsets:
+            table.frombytes(data[pos:pos+8*count])
+            if sys.byteorder=="big":
+                table.byteswap()
+            pos += 8*count
+        # record i is the line from offsets[i] to offsets[i+1]
+        self.records = memoryview(data)[pos:]
+        self.offsets.append(len(self.records))
+
+    def _record(self, i):
+        import json
+        return json.loads(bytes(self.records[self.offsets[i]:self.offsets[i+1]]))
+
+    def add(self, hash, hash2, **record):
+        """Add a record for a file whose digest is (hash, hash2). The remaining keyword
+        arguments (e.g. path and params, as from digest_params) are stored with it."""
+        record = dict(record, hash=hash.hex(), hash2=hash2.hex())
+        self.added.append((int.from_bytes(hash[:8].ljust(8, b"\0"), "big"), record))
+
+    def find(self, words, limit=None):
+        """Return the records whose word hash starts with the given words (a list, or
+        a space-separated string), up to limit records."""
+        import bisect
+        key, nbits = english_to_key(words)
+        value = int.from_bytes(key, "big")>>(len(key)*8-nbits)
+        # the range of 64 bit prefixes the words allow
+        bits = min(nbits, 64)
+        lo = (value>>(nbits-bits))<<(64-bits)
+        hi = lo+(1<<(64-bits))
+
+        def matches(record):
+            # compare any bits beyond the first 64 against the whole digest and padding
+            if nbits<=64:
+                return True
+            full = bytes.fromhex(record["hash"])+bytes.fromhex(record["hash2"])
+            return int.from_bytes(full, "big")>>(len(full)*8-nbits)==value
+
+        found = []
+        for i in range(bisect.bisect_left(self.prefixes, lo), bisect.bisect_left(self.prefixes, hi)):
+            record = self._record(i)
+            if matches(record):
+                found.append(record)
+        found += [record for prefix, record in self.added if lo<=prefix<hi and matches(record)]
+        return found[:limit] if limit is not None else found
+
+    def save(self):
+        """Merge any added records into the index file, writing it atomically."""
+        import array, json
+        # the last record added for each path and parameters replaces any earlier one
+        latest = {}
+        for prefix, record in self.added:
+            latest[record.get("path"), record.get("params")] = prefix, record
+        self.added = list(latest.values())
+        replaced = set(latest)
+        entries = []
+        for i in range(len(self.prefixes)):
+            line = bytes(self.records[self.offsets[i]:self.offsets[i+1]])
+            if replaced:
+                record = json.loads(line)
+                if (record.get("path"), record.get("params")) in replaced:
+                    continue
+            entries.append((self.prefixes[i], line))
+        entries += [(prefix, json.dumps(record, sort_keys=True).encode("utf-8")+b"\n") for prefix, record in self.added]
+        entries.sort(key=lambda entry: entry[0])
+
+        prefixes = array.array("Q", [prefix for prefix, line in entries])
+        offsets = array.array("Q")
+        pos = 0
+        for prefix, line in entries:
+            offsets.append(pos)
+            pos += len(line)
+        if sys.byteorder=="big":
+            prefixes.byteswap()
+            offsets.byteswap()
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(self.magic)
+            f.write(len(entries).to_bytes(8, "little"))
+            f.write(prefixes.tobytes())
+            f.write(offsets.tobytes())
+            for prefix, line in entries:
+                f.write(line)
+        os.replace(tmp, self.path)
+        self.added = []
+        self._load()
+
+
+def _walk_files(fnames):
+    """Yield each of the given paths, with each directory replaced by the regular files
+    under it, in sorted order. Symbolic links to directories are not followed."""
+    for fname in fnames:
+        if not os.path.isdir(fname):
+            yield fname
+            continue
+        for dirpath, dirnames, filenames in os.walk(fname):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if os.path.isfile(path):
+                    yield path
+
+
+def write_manifest(path, fnames, algo="sha512", n=None, sample=None, stats=None, **kwargs):
+    """Hash the given files, and every file under the given directories, and write a
+    manifest of them to path, for checking copies against later with check_manifest.
+
+    The manifest is a JSON lines file: a header giving the algorithm, the sampling
+    options and the root directory, then one line per file with its path relative to
+    the root, size, digest and words (n of them). The root is the directory given, or
+    the deepest directory containing all of the arguments, so a tree can be checked
+    against a copy of it elsewhere. If sample is a dict of sampling options for digest
+    (e.g. percent or detect), the sampled digest of each file is recorded too, so that
+    copies can be checked without reading them in full, along with the guarantee of its
+    plan if sampled adaptively. kwargs (jobs, processes, cache and the I/O options) are
+    passed to digest_files. Returns the number of files in the manifest."""
+    import json
+    fnames = list(fnames)
+    root = os.path.commonpath([os.path.abspath(fname) if os.path.isdir(fname) else os.path.dirname(os.path.abspath(fname))
+                               for fname in fnames]) if fnames else os.getcwd()
+    fnames = list(_walk_files(fnames))
+    full = digest_files(fnames, algo=algo, stats=stats, **kwargs)
+    if sample:
+        # the sampled pass reads only a fraction of each file, so runs in this thread,
+        # which otherwise just waits on the workers; most of the pages it reads are
+        # already cached by the full pass
+        sample_stats = Stats() if stats is not None else None
+        plans = {}
+        sampled = digest_files(fnames, algo=algo, stats=sample_stats, plans=plans,
+                               **dict(kwargs, jobs=1, processes=False, **sample))
+        # the full pass may finish out of order (e.g. with ordered=False), so sampled
+        # digests are matched to it by name
+        pending = {}
+
+        def sampled_digest(fname):
+            while fname not in pending:
+                name, (hash, hash2) = next(sampled)
+                pending[name] = hash, plans.pop(name)
+            return pending.pop(fname)
+
+    header = dict(english_hash_manifest=1, algo=algo, sample=sample or None, root=root)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            f.write(json.dumps(header, sort_keys=True)+"\n")
+            for fname, (hash, hash2) in full:
+                record = dict(path=os.path.relpath(os.path.abspath(fname), root), size=os.path.getsize(fname),
+                              hash=hash.hex(), hash2=hash2.hex(), words=hash_to_words(hash, hash2, n=n, stats=stats))
+                if sample:
+                    hash, plan = sampled_digest(fname)
+                    record["sample"] = hash.hex()
+                    if plan:
+                        record["guarantee"] = plan["guarantee"]
+                f.write(json.dumps(record, sort_keys=True)+"\n")
+        os.replace(tmp, path)
+    except BaseException:
+        # leave no partial manifest behind
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    if sample and stats is not None:
+        # each file is counted once, by the full pass
+        sample_stats.files = 0
+        stats.merge(sample_stats)
+    return len(fnames)
+
+
+def _check_file(item, algo="sha512", sample=None, full=False, **kwargs):
+    """Check one file against its manifest entry, item being (fname, size, hash,
+    sampled hash), returning its status as described in check_manifest."""
+    fname, size, hash, sampled = item
+    try:
+        if os.path.getsize(fname)!=size:
+            return "FAILED"
+        if sampled is not None:
+            # a mismatch here is conclusive, and costs only the sample
+            if digest_file(fname, algo=algo, **dict(kwargs, **sample))[0]!=sampled:
+                return "FAILED"
+            if not full:
+                return "OK (sampled)"
+        return "OK" if digest_file(fname, algo=algo, **kwargs)[0]==hash else "FAILED"
+    except FileNotFoundError:
+        return "MISSING"
+    except OSError:
+        return "UNREADABLE"
+
+
+def _check_file_stats(item, **kwargs):
+    """As _check_file, but returns (status, stats), where stats is a Stats of
+    the work done for this file alone."""
+    stats = Stats()
+    status = _check_file(item, stats=stats, **kwargs)
+    stats.add(files=1)
+    return status, stats
+
+
+def check_manifest(path, root=None, full=False, jobs=None, processes=False, ordered=True, fail_fast=False,
+                   stats=None, **kwargs):
+    """Check the files listed in the manifest at path (see write_manifest), yielding
+    (fname, status) pairs, where status is "OK", "OK (sampled)", "FAILED", "MISSING" or
+    "UNREADABLE". The paths in the manifest are taken relative to root, if given, such
+    as the directory of a copy, or else to the root the manifest was written from. A
+    manifest path that is absolute or leads out of root raises ValueError.
+
+    The size of each file is compared first. If the manifest has sampled digests, the
+    sampled digest is computed next, reading only a fraction of the file; a mismatch
+    fails the file, and a match gives "OK (sampled)" unless full is True, in which case
+    the file is also hashed in full. Digests are compared as bytes, never as words.
+    Files are checked in parallel as in digest_files, which describes jobs, processes,
+    ordered and stats; kwargs are the I/O options for digest. If fail_fast is True,
+    checking stops after the first file that is not OK, and queued work is cancelled."""
+    import functools, json
+    f = open(path, "rb")
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("english_hash_manifest")!=1:
+        f.close()
+        raise ValueError("%s is not a manifest" % path)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    sample = header.get("sample")
+    if root is None:
+        root = header.get("root", "")
+
+    def entries():
+        with f:
+            for line in f:
+                record = json.loads(line)
+                rel = os.path.normpath(record["path"])
+                if os.path.isabs(rel) or rel.split(os.sep)[0]==os.pardir:
+                    raise ValueError("%s lists %r, which is outside the directory being checked" % (path, record["path"]))
+                fname = os.path.join(root, rel)
+                yield (fname, record["size"], bytes.fromhex(record["hash"]),
+                       bytes.fromhex(record["sample"]) if sample and "sample" in record else None)
+
+    fn = functools.partial(_check_file if stats is None else _check_file_stats,
+                           algo=header["algo"], sample=sample, full=full, **kwargs)
+    results = _map_jobs(fn, entries(), jobs, processes=processes, ordered=ordered)
+    try:
+        for item, status in results:
+            if stats is not None:
+                status, file_stats = status
+                stats.merge(file_stats)
+                if stats.callback is not None:
+                    stats.callback(item[0], file_stats)
+            yield item[0], status
+            if fail_fast and not status.startswith("OK"):
+                return
+    finally:
+        results.close()
+
+
+def main(argv=None):
+    import argparse
     parser = argparse.ArgumentParser(description='Print a readable, pronounceable SHA512 hash of a file. Optionally, read a (repeatable) randomised subset of the file for faster hashing.')
     parser.add_argument('files', metavar='<file>', type=str, nargs='*',
-                   help='Files to be hashed.')
+                   help='Files to be hashed. - reads standard input.')
     parser.add_argument('-n','--nwords', dest='nwords', metavar='<n>', type=int,
-                   help='Number of words per hash. n=43 is maximum; n=12 is default.')
+                   help='Number of words per hash. n=43 is maximum for 512 bit hashes; n=12 is default.')
+    parser.add_argument('-a','--algo', dest='algo', metavar='<algo>', default='sha512', choices=sorted(hash_backends),
+                   help='Hash algorithm: one of %s. Default is sha512. blake2b-tree hashes each file on several cores.' % ", ".join(sorted(hash_backends)))
     parser.add_argument('-p','--percent', dest='percent', metavar='<n>', type=float,
                    help='Percentage of file to inspect, as float [0.0, 100.0]. Forces randomisation, even if n=100. Only one of --percent and --blocks should be specified.')
     parser.add_argument('-b','--blocks', dest='blocks', metavar='<n>', type=int,
                    help='Number of blocks to inspect. Forces randomisation. Only one of --percent and --blocks should be specified.')
     parser.add_argument('-k','--block-size', dest='block_size', metavar='<n>', type=int,
                    help='Size of blocks in randomised mode. Default is 512 bytes.')
-    
+
     parser.add_argument('--min-blocks', dest='min_blocks', metavar='<n>', type=int,
                    help='Minimum number of blocks to inspect in randomised mode. First and last block are always inspected.')
     parser.add_argument('--max-blocks', dest='max_blocks', metavar='<n>', type=int,
-                   help='Maximum number of blocks to inspect in randomised mode. First and last block are always inspected.')                                                                                               
-    args = parser.parse_args()
-    
+                   help='Maximum number of blocks to inspect in randomised mode. First and last block are always inspected.')
+    parser.add_argument('--detect', dest='detect', metavar='<bytes>', type=int,
+                   help='Sample adaptively, choosing the block size and count so that a change to any run of this many bytes alters the hash with probability --confidence. Each hash is followed by the probability achieved. Files are read whole if that is cheaper.')
+    parser.add_argument('--confidence', dest='confidence', metavar='<p>', type=float, default=0.999,
+                   help='Probability of detecting a change of --detect bytes. Default is 0.999.')
+    parser.add_argument('--budget-bytes', dest='max_bytes', metavar='<n>', type=int,
+                   help='With --detect, read at most this many bytes of each file, even if that falls short of --confidence.')
+    parser.add_argument('--budget-seconds', dest='max_seconds', metavar='<s>', type=float,
+                   help='With --detect, spend at most about this long reading each file, even if that falls short of --confidence.')
+    parser.add_argument('--queue-depth', dest='queue_depth', metavar='<n>', type=int,
+                   help='Number of reads to issue concurrently in randomised mode. Default is 1 (serial reads).')
+    parser.add_argument('--read-size', dest='read_size', metavar='<n>', type=int,
+                   help='Size of reads when hashing whole files. Default is 1048576 bytes.')
+    parser.add_argument('--mmap', dest='use_mmap', action='store_true',
+                   help='Memory-map files when hashing whole files, rather than reading them into a reused buffer. Only safe for files that are not truncated while they are hashed.')
+    parser.add_argument('-r','--recursive', dest='recursive', action='store_true',
+                   help='Hash directories recursively, printing a single hash for each directory tree.')
+    parser.add_argument('--subdirs', dest='subdirs', action='store_true',
+                   help='With --recursive, also print the hash of every subdirectory, followed by its path.')
+    parser.add_argument('--cache', dest='cache', metavar='<path>', type=str,
+                   help='Cache digests in the given SQLite database, keyed on path, inode, size and modification time, so unchanged files are not read again.')
+    parser.add_argument('--cache-size', dest='cache_size', metavar='<n>', type=int, default=1000000,
+                   help='Maximum number of digests to keep in the cache; the least recently used are evicted. Default is 1000000.')
+    parser.add_argument('--index', dest='index', metavar='<path>', type=str,
+                   help='Add the hashes of the given files to the hash index at the given path, for later use with --lookup.')
+    parser.add_argument('--lookup', dest='lookup', metavar='<words>', type=str,
+                   help='Print the files in the hash index (given by --index) whose hash starts with the given words, e.g. the first four words read out over the phone.')
+    parser.add_argument('--write-manifest', dest='write_manifest', metavar='<path>', type=str,
+                   help='Write a manifest of the given files, and every file under the given directories, to the given path, with the size, digest and words of each. With --percent, --blocks or --detect, sampled digests are recorded too, for a faster --check.')
+    parser.add_argument('--check', dest='check', metavar='<path>', type=str,
+                   help='Check files against the manifest at the given path, printing the status of each. A directory may be given, against which the paths in the manifest are resolved. Exits with status 1 if any file does not match.')
+    parser.add_argument('--full', dest='full', action='store_true',
+                   help='With --check, also hash in full the files whose sampled digest matches.')
+    parser.add_argument('--fail-fast', dest='fail_fast', action='store_true',
+                   help='With --check, stop at the first file that does not match.')
+    parser.add_argument('-j','--jobs', dest='jobs', metavar='<n>', type=int, default=1,
+                   help='Number of files to hash in parallel. Default is 1; 0 uses one worker per CPU.')
+    parser.add_argument('--processes', dest='processes', action='store_true',
+                   help='Use a process pool rather than a thread pool for --jobs.')
+    parser.add_argument('--unordered', dest='unordered', action='store_true',
+                   help='Print each hash as soon as it is ready, rather than in input order. Each line is then followed by its file name.')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                   help='Print a summary of bytes read, reads, seeks, cache hits and time spent in I/O, hashing and encoding to stderr.')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                   help='Run under cProfile, printing the most expensive functions to stderr. Work done in worker threads or processes is not included.')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        import cProfile, pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(_run, parser, args)
+        finally:
+            pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    return _run(parser, args)
+
+
+def _tree_guarantees(top, plans):
+    """Return a dict mapping each directory under top, relative to it as in digest_tree,
+    to the lowest guarantee of the plans (as filled in by digest_files) of the files
+    under it. A change to any one file is detected with at least that probability."""
+    guarantees = {".": 1.0}
+    for fname, plan in plans.items():
+        rel = os.path.dirname(os.path.normpath(os.path.relpath(fname, top))) or "."
+        while True:
+            guarantees[rel] = min(guarantees.get(rel, 1.0), plan.get("guarantee", 1.0))
+            if rel==".":
+                break
+            rel = os.path.dirname(rel) or "."
+    return guarantees
+
+
+def _run(parser, args):
+    """Carry out the command line parsed into args."""
     n = args.nwords
-    
+
     if n is None:
-        n = 12        
-        
-    sha = hashlib.sha512()        
-    if len(args.files)==0:
+        n = 12
+
+    options = dict(percent=args.percent, blocks=args.blocks, block_size=args.block_size,
+                   min_blocks=args.min_blocks, max_blocks=args.max_blocks,
+                   queue_depth=args.queue_depth, read_size=args.read_size, use_mmap=args.use_mmap)
+    if args.detect is not None:
+        if args.percent is not None or args.blocks is not None:
+            parser.error('--detect cannot be combined with --percent or --blocks')
+        if not 0<args.confidence<=1:
+            parser.error('--confidence must be greater than 0 and at most 1')
+        try:
+            # a file far larger than any budget, so this fails only if no sample can fit
+            plan_adaptive(1<<50, args.detect, args.confidence, max_bytes=args.max_bytes, max_seconds=args.max_seconds)
+        except ValueError as e:
+            parser.error(str(e))
+        # only when given, so that digest_params, and cached and indexed digests, are unchanged otherwise
+        options.update(detect=args.detect, confidence=args.confidence, max_bytes=args.max_bytes, max_seconds=args.max_seconds)
+    stats = Stats() if args.stats else None
+    status = 0
+    if args.check is not None:
+        if len(args.files)>1 or (args.files and not os.path.isdir(args.files[0])):
+            parser.error('--check takes at most one directory')
+        io_options = dict((k, options[k]) for k in _io_options if k in options)
+        try:
+            for file, result in check_manifest(args.check, root=args.files[0] if args.files else None, full=args.full,
+                                               jobs=args.jobs or None, processes=args.processes, ordered=not args.unordered,
+                                               fail_fast=args.fail_fast, stats=stats, **io_options):
+                print("%s: %s" % (file, result))
+                if not result.startswith("OK"):
+                    status = 1
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.write_manifest is not None:
+        if not args.files or "-" in args.files:
+            parser.error('--write-manifest requires files or directories to hash')
+        io_options = dict((k, options[k]) for k in _io_options if k in options)
+        sample = None
+        if args.percent is not None or args.blocks is not None or args.detect is not None:
+            sample = dict((k, v) for k, v in options.items() if k not in _io_options)
+        cache = HashCache(args.cache, max_entries=args.cache_size) if args.cache else None
+        try:
+            write_manifest(args.write_manifest, args.files, algo=args.algo, n=n, sample=sample, jobs=args.jobs or None,
+                           processes=args.processes, cache=cache, stats=stats, **io_options)
+        finally:
+            if cache is not None:
+                cache.close()
+    elif args.lookup is not None:
+        if args.index is None:
+            parser.error('--lookup requires --index')
+        try:
+            found = HashIndex(args.index).find(args.lookup)
+        except ValueError as e:
+            parser.error(str(e))
+        for record in found:
+            print("%s  %s" % (hash_to_words(bytes.fromhex(record["hash"]), bytes.fromhex(record["hash2"]), n=n), record["path"]))
+        return 0 if found else 1
+    elif len(args.files)==0 and (sys.stdin is None or sys.stdin.isatty()):
         # by default, hash this script
         thisfile = os.path.realpath(sys.argv[0])
-        print "Hash of this script (%s):  %s"  % (sys.argv[0], wordhash_file(sha, thisfile, n=n, 
-        percent=args.percent, blocks=args.blocks, block_size=args.block_size, min_blocks=args.min_blocks, max_blocks=args.max_blocks))
+        plan = {}
+        words = wordhash_file(new_hash(args.algo), thisfile, n=n, stats=stats, plan=plan, **options)
+        if args.detect is not None:
+            words = "%s  p=%.4f" % (words, plan["guarantee"])
+        print("Hash of this script (%s):  %s"  % (sys.argv[0], words))
+        if stats is not None:
+            stats.add(files=1)
     else:
-        # hash the given files
-        for file in args.files:
-            print wordhash_file(sha,file,n=n,percent=args.percent, blocks=args.blocks, block_size=args.block_size, min_blocks=args.min_blocks, max_blocks=args.max_blocks)
-    
+        # hash the given files, or standard input if there are none
+        files = args.files or ["-"]
+        jobs = args.jobs or None
+        cache = HashCache(args.cache, max_entries=args.cache_size) if args.cache else None
+        try:
+            if args.recursive:
+                for file in files:
+                    plans = {} if args.detect is not None else None
+                    if os.path.isdir(file):
+                        nodes = digest_tree(file, algo=args.algo, jobs=jobs, processes=args.processes, cache=cache,
+                                            stats=stats, plans=plans, **options)
+                        guarantees = _tree_guarantees(file, plans) if plans is not None else None
+                        for rel in sorted(nodes) if args.subdirs else ["."]:
+                            words = hash_to_words(*nodes[rel], n=n, stats=stats)
+                            if guarantees is not None:
+                                words = "%s  p=%.4f" % (words, guarantees.get(rel, 1.0))
+                            if args.subdirs:
+                                print("%s  %s" % (words, os.path.normpath(os.path.join(file, rel))))
+                            else:
+                                print(words)
+                    else:
+                        for file, words in wordhash_files([file], n=n, algo=args.algo, jobs=1, cache=cache, stats=stats,
+                                                          plans=plans, **options):
+                            if plans is not None:
+                                words = "%s  p=%.4f" % (words, plans.pop(file)["guarantee"])
+                            print("%s  %s" % (words, file) if args.subdirs else words)
+            else:
+                index = HashIndex(args.index) if args.index else None
+                plans = {} if args.detect is not None else None
+                for file, (hash, hash2) in digest_files(files, algo=args.algo, jobs=jobs, processes=args.processes,
+                                                        ordered=not args.unordered, cache=cache, stats=stats,
+                                                        plans=plans, **options):
+                    if index is not None and file!="-":
+                        index.add(hash, hash2, path=os.path.abspath(file), params=digest_params(args.algo, **options))
+                    words = hash_to_words(hash, hash2, n=n, stats=stats)
+                    if plans is not None:
+                        words = "%s  p=%.4f" % (words, plans.pop(file)["guarantee"])
+                    if args.unordered:
+                        print("%s  %s" % (words, file))
+                    else:
+                        print(words)
+                if index is not None:
+                    index.save()
+        finally:
+            if cache is not None:
+                cache.close()
+    if stats is not None:
+        print(stats.summary(), file=sys.stderr)
+    return status
+
 
+if __name__=="__main__":
+    sys.exit(main())